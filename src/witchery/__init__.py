@@ -10,30 +10,121 @@ This library has methods to guess which variables are unknown and to potentially
 import ast
 import builtins
 import contextlib
+import functools
 import importlib
 import inspect
+import keyword
+import re
 import textwrap
 import typing
 import warnings
 from _ast import NamedExpr
+from dataclasses import dataclass, field, fields
 from typing import Any
 
 from typing_extensions import Self
 
-BUILTINS = set(builtins.__dict__.keys())
+from . import _cache
+
+BUILTINS: frozenset[str] = frozenset(builtins.__dict__)
+
+
+def _parse_fresh(code: str) -> ast.Module:
+    """
+    Parse code into a new AST.
+
+    Same as `ast.parse`, but calls `compile` directly and uses '<witchery>' as filename,
+    so a SyntaxError shows it came from code passed to witchery.
+    """
+    return typing.cast(ast.Module, compile(code, "<witchery>", "exec", flags=ast.PyCF_ONLY_AST, dont_inherit=True))
+
+
+@functools.lru_cache(maxsize=128)
+def _parse(code: str) -> ast.Module:
+    """
+    Parse code into an AST, cached so looking up things in the same code multiple times only parses it once.
+
+    Used by `has_local_imports` and `find_function_to_call`; `analyze` parses fresh,
+    since it caches its result and holding on to the whole tree as well would only cost memory.
+
+    The returned tree is shared between callers, so it should NOT be modified!
+    Functions that transform the tree should use `_parse_fresh` instead.
+    """
+    return _parse_fresh(code)
+
+
+def _reversed_children(node: ast.AST) -> list[ast.AST]:
+    """
+    Get the direct child nodes of this node, last one first.
+
+    Reversed so that pushing them onto a stack pops (and thus visits) the first child first.
+    """
+    children: list[ast.AST] = []
+    for name in node._fields:
+        value = getattr(node, name, None)
+        if isinstance(value, list):
+            children.extend([item for item in value if isinstance(item, ast.AST)])
+        elif isinstance(value, ast.AST):
+            children.append(value)
+
+    children.reverse()
+    return children
 
 
 def traverse_ast(node: ast.AST, variable_collector: typing.Callable[[ast.AST], None]) -> None:
     """
-    Recursively traverses the given AST node and applies the variable collector function on each node.
+    Traverses the given AST node and applies the variable collector function on each node.
+
+    Nodes are visited depth-first in source order (the collectors depend on this, e.g. for `del`),
+    using an explicit stack instead of recursion to avoid a Python frame per node.
 
     Args:
         node (ast.AST): The AST node to traverse.
         variable_collector (Callable): The function to apply on each node.
     """
-    variable_collector(node)
-    for child in ast.iter_child_nodes(node):
-        traverse_ast(child, variable_collector)
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        variable_collector(node)
+        stack.extend(_reversed_children(node))
+
+
+# fields that can contain statements (or except handlers and match cases, which contain statements):
+_STATEMENT_FIELDS = ("body", "orelse", "finalbody", "handlers", "cases")
+
+
+def _iter_statements(tree: ast.AST) -> typing.Iterator[ast.AST]:
+    """
+    Yield every statement in the tree, without descending into expressions (unlike `ast.walk`).
+
+    Useful to look for things that can only be statements, such as imports and function definitions.
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        for name in _STATEMENT_FIELDS:
+            if children := getattr(node, name, None):
+                stack.extend(children)
+
+
+def _handle_elts(elts: typing.Iterable[ast.expr], variables: set[str]) -> None:
+    """
+    Add the names assigned to by the given targets, handling recursive definitions such as tuples.
+    """
+    pending = list(elts)
+    while pending:
+        node = pending.pop()
+        # exact type checks are faster than isinstance and AST node classes aren't subclassed:
+        if type(node) is ast.Subscript or type(node) is ast.Starred:
+            # x[...] = or *x =
+            node = node.value
+
+        if type(node) is ast.Tuple or type(node) is ast.List:
+            # (x, y) = or [x, y] =; handle nested elements in the same loop instead of recursing
+            pending.extend(node.elts)
+        elif type(node) is ast.Name:
+            variables.add(node.id)
 
 
 def find_defined_variables(code_str: str) -> set[str]:
@@ -52,42 +143,46 @@ def find_defined_variables(code_str: str) -> set[str]:
     Returns:
         set[str]: A set of variable names that are defined within the provided Python code.
     """
-    tree: ast.Module = ast.parse(code_str)
+    return set(analyze(code_str).assigned)
 
-    variables: set[str] = set()
-
-    def collect_definitions(node: ast.AST) -> None:
-        if not isinstance(node, (ast.Assign, ast.AnnAssign)):
-            # only look for variable definitions here!
-            return
 
-        # define function that can be recursed:
-        def handle_elts(elts: typing.Iterable[ast.expr]) -> None:
-            for node in elts:
-                # with contextlib.suppress(Exception):
-                try:
-                    if isinstance(node, ast.Subscript):
-                        node = node.value
-
-                    if isinstance(node, ast.Tuple):
-                        # recurse
-                        handle_elts(node.elts)
-                        continue
+class _StatementTransformer(ast.NodeTransformer):
+    """
+    NodeTransformer that only visits statements, since expressions can't contain statements to transform.
+    """
 
-                    if var := getattr(node, "id", None):
-                        variables.add(var)
+    # node type -> visit method, filled per subclass so `visit` doesn't have to build and look up a name every time:
+    _visitors: typing.ClassVar[dict[type[ast.AST], typing.Callable[[typing.Any, typing.Any], typing.Any]]] = {}
 
-                except Exception as e:  # pragma: no cover
-                    warnings.warn("Something went wrong trying to find variables.", source=e)
-                    # raise
+    def __init_subclass__(cls, **kwargs: typing.Any) -> None:
+        """
+        Give every transformer its own dispatch cache, since their visit_ methods differ.
+        """
+        super().__init_subclass__(**kwargs)
+        cls._visitors = {}
 
-        handle_elts(node.targets if hasattr(node, "targets") else [node.target])
+    def visit(self, node: ast.AST) -> typing.Any:
+        """
+        Call the visit_ method for this type of node, or generic_visit if there is none.
+        """
+        node_type = type(node)
+        if (visitor := self._visitors.get(node_type)) is None:
+            cls = type(self)
+            visitor = self._visitors[node_type] = getattr(cls, f"visit_{node_type.__name__}", cls.generic_visit)
+        return visitor(self, node)
 
-    traverse_ast(tree, collect_definitions)
-    return variables
+    def generic_visit(self, node: ast.AST) -> ast.AST:
+        """
+        Visit the nested statements of this node (in its body, else, finally, except and case blocks).
+        """
+        for name in _STATEMENT_FIELDS:
+            if statements := getattr(node, name, None):
+                # leave out the statements that were removed:
+                setattr(node, name, [new for statement in statements if (new := self.visit(statement)) is not None])
+        return node
 
 
-class IfBlockRemover(ast.NodeTransformer):
+class IfBlockRemover(_StatementTransformer):
     """
     Remove if False or if typing.TYPE_CHECKING.
     """
@@ -108,17 +203,64 @@ class IfBlockRemover(ast.NodeTransformer):
         ):
             return None
 
+        # only visits the body and else, since `node.test` can't contain nested if-statements:
         return self.generic_visit(node)
 
 
+# transformers without state can be shared by every call:
+_IF_BLOCK_REMOVER = IfBlockRemover()
+
+
+def remove_if_falsey_blocks_tree(tree: ast.Module) -> ast.Module:
+    """
+    Remove if False or if typing.TYPE_CHECKING from an already parsed tree (which is modified in place).
+    """
+    return typing.cast(ast.Module, _IF_BLOCK_REMOVER.visit(tree))
+
+
 def remove_if_falsey_blocks(code: str) -> str:
     """
     Remove if False or if typing.TYPE_CHECKING.
     """
-    tree = ast.parse(code)
-    remover = IfBlockRemover()
-    new_tree = remover.visit(tree)
-    return ast.unparse(new_tree)
+    return ast.unparse(remove_if_falsey_blocks_tree(_parse_fresh(code)))
+
+
+class VariableRemover(_StatementTransformer):
+    """
+    Node visitor to remove variable definitions, functions and classes with specific names (even in blocks).
+    """
+
+    def __init__(self, to_remove: typing.Iterable[str]) -> None:
+        """
+        Set the variable names to remove.
+        """
+        # a frozenset for O(1) lookups, also when a list or (single-use) generator is passed:
+        self.to_remove = frozenset(to_remove)
+
+    def visit_Assign(self, node: ast.Assign) -> ast.Assign | None:
+        """
+        Removes `name = ...` if any of the assignment targets should be removed.
+        """
+        if any(type(target) is ast.Name and target.id in self.to_remove for target in node.targets):
+            return None
+        # an assignment can't contain other statements, so no need to visit its children:
+        return node
+
+    def visit_FunctionDef(self, node: ast.FunctionDef) -> ast.AST | None:
+        """
+        Removes `def name(): ...`.
+        """
+        if node.name in self.to_remove:
+            return None
+        return self.generic_visit(node)
+
+    def visit_ClassDef(self, node: ast.ClassDef) -> ast.AST | None:
+        """
+        Removes `class name: ...`.
+        """
+        if node.name in self.to_remove:
+            return None
+        return self.generic_visit(node)
 
 
 def remove_specific_variables(code: str, to_remove: typing.Iterable[str] = ("db", "database")) -> str:
@@ -132,39 +274,25 @@ def remove_specific_variables(code: str, to_remove: typing.Iterable[str] = ("db"
     Returns:
         str: The code after removing the specified variables.
     """
-    # Parse the code into an Abstract Syntax Tree (AST)
-    tree = ast.parse(code)
-
-    # Function to check if a variable name is 'db' or 'database'
-    def should_remove(var_name: str) -> bool:
-        return var_name in to_remove
-
-    # Function to recursively traverse the AST and remove lines with 'db' or 'database' definitions
-    def remove_desired_variable_refs(node: ast.AST) -> typing.Optional[ast.AST]:
-        if isinstance(node, ast.Assign):
-            # Check if any of the assignment targets contain 'db' or 'database'
-            if any(isinstance(target, ast.Name) and should_remove(target.id) for target in node.targets):
-                return None
-
-        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)) and should_remove(node.name):
-            return None
-
-        # doesn't work well without list() !!!
-        for child_node in list(ast.iter_child_nodes(node)):
-            new_child_node = remove_desired_variable_refs(child_node)
-            if new_child_node is None and hasattr(node, "body"):
-                node.body.remove(child_node)
+    # Parse the code into an Abstract Syntax Tree (AST), remove the variables and generate the modified code
+    return ast.unparse(remove_specific_variables_tree(_parse_fresh(code), to_remove))
 
-        return node
 
-    # Traverse the AST to remove 'db' and 'database' definitions
-    new_tree = remove_desired_variable_refs(tree)
+def remove_specific_variables_tree(
+    tree: ast.Module, to_remove: typing.Iterable[str] = ("db", "database")
+) -> ast.Module:
+    """
+    Removes specific variables from an already parsed tree (which is modified in place).
 
-    if not new_tree:  # pragma: no cover
-        return ""
+    Args:
+        tree (ast.Module): The parsed code from which to remove variables.
+        to_remove (Iterable): An iterable of variable names to be removed.
 
-    # Generate the modified code from the new AST
-    return ast.unparse(new_tree)
+    Returns:
+        ast.Module: The tree after removing the specified variables.
+    """
+    # Traverse the AST to remove e.g. 'db' and 'database' definitions
+    return typing.cast(ast.Module, VariableRemover(to_remove).visit(tree))
 
 
 def has_local_imports(code: str) -> bool:
@@ -177,19 +305,18 @@ def has_local_imports(code: str) -> bool:
     Returns:
         bool: True if local imports are found, False otherwise.
     """
+    tree = _parse(code)
 
-    class FindLocalImports(ast.NodeVisitor):
-        def visit_ImportFrom(self, node: ast.ImportFrom) -> bool:
-            if node.level > 0:  # This means it's a relative import
+    # most imports are at the top level, so check those before walking all (nested) statements:
+    for nodes in (tree.body, _iter_statements(tree)):
+        for node in nodes:
+            if type(node) is ast.ImportFrom and node.level > 0:  # This means it's a relative import
                 return True
-            return False
 
-    tree = ast.parse(code)
-    visitor = FindLocalImports()
-    return any(visitor.visit(node) for node in ast.walk(tree))
+    return False
 
 
-class ImportRemover(ast.NodeTransformer):
+class ImportRemover(_StatementTransformer):
     """
     Node visitor to remove imports (even in blocks).
     """
@@ -216,6 +343,14 @@ class ImportRemover(ast.NodeTransformer):
         return node
 
 
+@functools.lru_cache(maxsize=32)
+def _import_remover(module_name: str) -> ImportRemover:
+    """
+    Get a (shared) ImportRemover for a module name, which is its only state.
+    """
+    return ImportRemover(module_name)
+
+
 def remove_import(code: str, module_name: str) -> str:
     """
     Removes the import of a specific module from the given code, including inner scopes.
@@ -232,10 +367,26 @@ def remove_import(code: str, module_name: str) -> str:
         warnings.warn("`remove_import` called without module name!")
         return code
 
-    tree = ast.parse(code)
-    transformer = ImportRemover(module_name)
-    tree = transformer.visit(tree)
-    return ast.unparse(tree)
+    return ast.unparse(remove_import_tree(_parse_fresh(code), module_name))
+
+
+def remove_import_tree(tree: ast.Module, module_name: str) -> ast.Module:
+    """
+    Removes the import of a specific module from an already parsed tree (which is modified in place).
+
+    Args:
+        tree (ast.Module): The parsed code from which to remove the import.
+        module_name (str): The name of the module to remove.
+
+    Returns:
+        ast.Module: The tree after removing the import of the specified module.
+    """
+    if not module_name:
+        # nothing to remove
+        warnings.warn("`remove_import_tree` called without module name!")
+        return tree
+
+    return typing.cast(ast.Module, _import_remover(module_name).visit(tree))
 
 
 def remove_local_imports(code: str) -> str:
@@ -249,14 +400,54 @@ def remove_local_imports(code: str) -> str:
         str: The code after removing all local imports.
     """
 
-    class RemoveLocalImports(ast.NodeTransformer):
-        def visit_ImportFrom(self, node: ast.ImportFrom) -> typing.Optional[ast.ImportFrom]:
-            if node.level > 0:  # This means it's a relative import
-                return None  # Remove the node
-            return node  # Keep the node
+    return ast.unparse(remove_local_imports_tree(_parse_fresh(code)))
+
+
+def remove_local_imports_tree(tree: ast.Module) -> ast.Module:
+    """
+    Removes all local imports from an already parsed tree (which is modified in place).
+
+    Args:
+        tree (ast.Module): The parsed code from which to remove local imports.
+
+    Returns:
+        ast.Module: The tree after removing all local imports.
+    """
+    # filter the statement lists directly, without the NodeTransformer's method dispatch for every statement:
+    stack: list[ast.AST] = [tree]
+    while stack:
+        node = stack.pop()
+        for name in _STATEMENT_FIELDS:
+            if statements := getattr(node, name, None):
+                # level > 0 means it's a relative import
+                statements = [stmt for stmt in statements if not (type(stmt) is ast.ImportFrom and stmt.level > 0)]
+                setattr(node, name, statements)
+                # nested blocks (functions, if TYPE_CHECKING etc.) can also contain imports:
+                stack.extend(statements)
+
+    return tree
 
-    tree = ast.parse(code)
-    tree = RemoveLocalImports().visit(tree)
+
+TreeTransformer = typing.Callable[[ast.Module], ast.Module]
+
+
+def pipeline(code: str, steps: typing.Iterable[TreeTransformer]) -> str:
+    """
+    Apply multiple `*_tree` transformations to the given code, parsing and unparsing it only once.
+
+    Example:
+        pipeline(code, [remove_local_imports_tree, functools.partial(remove_import_tree, module_name="pydal")])
+
+    Args:
+        code (str): The code to transform.
+        steps (Iterable): Functions that take and return an `ast.Module`, applied in order.
+
+    Returns:
+        str: The code after applying every step.
+    """
+    tree = _parse_fresh(code)
+    for step in steps:
+        tree = step(tree)
     return ast.unparse(tree)
 
 
@@ -272,15 +463,32 @@ def find_function_to_call(code: str, function_call_hint: str) -> typing.Optional
         str, optional: The name of the function to call if found, None otherwise.
     """
     function_name = function_call_hint.split("(")[0]  # Extract function name from hint
-    tree = ast.parse(code)
-    return next(
-        (function_name for node in ast.walk(tree) if isinstance(node, ast.FunctionDef) and node.name == function_name),
-        None,
-    )
+    tree = _parse(code)
+
+    # usually the function is defined at the top level, so check there before walking all (nested) statements:
+    for nodes in (tree.body, _iter_statements(tree)):
+        for node in nodes:
+            if type(node) is ast.FunctionDef and node.name == function_name:
+                return function_name
+
+    return None
 
 
 DEFAULT_ARGS = ("db",)
 
+# names, ints and 'strings' (without quotes, backslashes or commas), which `ast.unparse` would return as-is:
+_SIMPLE_ARGUMENT = r" *(?:[A-Za-z_]\w*|0|[1-9]\d*|'[^'\\,]*') *"
+_SIMPLE_ARGUMENTS = re.compile(rf"{_SIMPLE_ARGUMENT}(?:,{_SIMPLE_ARGUMENT})*")
+# these are keywords but also valid arguments:
+_CONSTANT_KEYWORDS = {"True", "False", "None"}
+
+
+def _is_simple_name(name: str) -> bool:
+    """
+    Is this an (ascii) identifier that can be used as a variable name?
+    """
+    return name.isascii() and name.isidentifier() and not keyword.iskeyword(name)
+
 
 def extract_function_details(
     function_call: str, default_args: typing.Iterable[str] = DEFAULT_ARGS
@@ -295,12 +503,23 @@ def extract_function_details(
     Returns:
         tuple: A tuple containing the function name and a list of arguments.
     """
-    function_name = function_call.split("(")[0]  # Extract function name from hint
-    if "(" not in function_call:
+    function_name, parenthesis, rest = function_call.partition("(")  # Extract function name from hint
+    if not parenthesis:
         return function_name, list(default_args)
 
+    # fast path for the common `name()` and `name(simple, 'args')`, without building and unparsing an AST:
+    if _is_simple_name(function_name) and rest.endswith(")"):
+        arguments = rest[:-1]
+        if not arguments.strip(" "):
+            return function_name, list(default_args)
+
+        if arguments.isascii() and arguments.isprintable() and _SIMPLE_ARGUMENTS.fullmatch(arguments):
+            args = [argument.strip(" ") for argument in arguments.split(",")]
+            if not any(keyword.iskeyword(arg) and arg not in _CONSTANT_KEYWORDS for arg in args):
+                return function_name, args
+
     with contextlib.suppress(SyntaxError):
-        tree = ast.parse(function_call)
+        tree = _parse_fresh(function_call)
         for node in ast.walk(tree):
             if isinstance(node, ast.Call):
                 if len(node.args) == 0:
@@ -313,6 +532,15 @@ def extract_function_details(
     return None, []
 
 
+def _arg_value(arg: str) -> ast.Name:
+    """
+    Parse a function call argument (e.g. 'db') into an AST node.
+    """
+    # make mypy happy
+    body = typing.cast(NamedExpr, _parse_fresh(arg).body[0])
+    return typing.cast(ast.Name, body.value)
+
+
 def add_function_call(
     code: str, function_call: str, args: typing.Iterable[str] = DEFAULT_ARGS, multiple: bool = False
 ) -> str:
@@ -328,161 +556,321 @@ def add_function_call(
     Returns:
         str: The code after adding the function call.
     """
-    function_name, args = extract_function_details(function_call, default_args=args)
+    return ast.unparse(add_function_call_tree(_parse_fresh(code), function_call, args, multiple))
 
-    def arg_value(arg: str) -> ast.Name:
-        # make mypy happy
-        body = typing.cast(NamedExpr, ast.parse(arg).body[0])
-        return typing.cast(ast.Name, body.value)
 
-    tree = ast.parse(code)
+def add_function_call_tree(
+    tree: ast.Module, function_call: str, args: typing.Iterable[str] = DEFAULT_ARGS, multiple: bool = False
+) -> ast.Module:
+    """
+    Adds a function call to an already parsed tree (which is modified in place).
+
+    Args:
+        tree (ast.Module): The parsed code to which to add the function call.
+        function_call (str): The function call string.
+        args (Iterable, optional): The arguments for the function call.
+        multiple (bool, optional): If True, add a call after every function with the specified name.
+
+    Returns:
+        ast.Module: The tree after adding the function call.
+    """
+    function_name, args = extract_function_details(function_call, default_args=args)
+
     # Create a function call node
     new_call = ast.Call(
         func=ast.Name(id=function_name, ctx=ast.Load()),
-        args=[arg_value(arg) for arg in args] if args else [],
+        args=[_arg_value(arg) for arg in args] if args else [],
         keywords=[],
     )
     func_call = ast.Expr(value=new_call)
 
     # Insert the function call right after the function definition
-    for i, node in enumerate(tree.body):
-        if isinstance(node, ast.FunctionDef) and node.name == function_name:
-            tree.body.insert(i + 1, func_call)
-            if not multiple:
-                break
+    # (by building a new body in one pass, since every list.insert would shift the rest of the body)
+    body: list[ast.stmt] = []
+    inserted = False
+    for node in tree.body:
+        body.append(node)
+        if type(node) is ast.FunctionDef and node.name == function_name and (multiple or not inserted):
+            body.append(func_call)
+            inserted = True
 
-    return ast.unparse(tree)
+    tree.body = body
 
+    return tree
 
-def find_variables(code_str: str, with_builtins: bool = True) -> tuple[set[str], set[str]]:
-    """
-    Finds all used and defined variables in the given code string.
 
-    Args:
-        code_str (str): The code string to parse for variables.
-        with_builtins (bool): include Python builtins?
+# code that starts with indentation (after optional empty lines):
+_LEADING_INDENT = re.compile(r"[\r\n]*[ \t]")
 
-    Returns:
-        tuple: A tuple containing sets of used and defined variables.
+
+@dataclass(slots=True)
+class _VariableState:
     """
-    # Partly made by ChatGPT
-    code_str = textwrap.dedent(code_str)
+    The variables collected by `find_variables` while walking the AST.
 
-    # could raise SyntaxError
-    tree: ast.Module = ast.parse(code_str)
+    Passed explicitly to every collector (instead of closing over separate sets),
+    with __slots__ for fast attribute access in the hot loop.
+    """
 
-    used_variables: set[str] = set()
-    defined_variables: set[str] = set()
-    imported_modules: set[str] = set()
-    imported_names: set[str] = set()
-    loop_variables: set[str] = set()
+    used: set[str] = field(default_factory=set)
+    defined: set[str] = field(default_factory=set)
+    assigned: set[str] = field(default_factory=set)
+    imported_names: set[str] = field(default_factory=set)
+    loop: set[str] = field(default_factory=set)
+    # modules of `from module import *`, only resolved to names when needed (see `_star_imported`):
+    star_imports: set[str] = field(default_factory=set)
 
-    def collect_variables(node: ast.AST) -> None:
-        """
-        Collect or remove variables based on load/store and delete statements.
+    def collect(self, tree: ast.AST) -> None:
         """
-        if isinstance(node, ast.Name):
-            if isinstance(node.ctx, ast.Load):
-                used_variables.add(node.id)
-            elif isinstance(node.ctx, ast.Store):
-                defined_variables.add(node.id)
-            elif isinstance(node.ctx, ast.Del):
-                defined_variables.discard(node.id)
+        Run the collector for each type of node (if any) to get all variables from the code.
 
-    def collect_definitions(node: ast.AST) -> None:
+        This is `traverse_ast` with the dispatch inlined into the loop (both use `_reversed_children`),
+        which saves a Python function call for every node without a collector (most of them).
         """
-        Collect variable definitions via other ways.
-        """
-        if not isinstance(node, (ast.Assign, ast.AnnAssign)):
-            return
+        dispatch = _DISPATCH
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if handler := dispatch.get(type(node)):
+                handler(node, self)
+            stack.extend(_reversed_children(node))
 
-        def handle_elts(elts: list[ast.expr]) -> None:
-            """
-            Handle recursive definitions such as tuples.
-            """
-            for node in elts:
-                # with contextlib.suppress(Exception):
-                try:
-                    if isinstance(node, ast.Subscript):
-                        node = node.value
 
-                    if isinstance(node, ast.Tuple):
-                        # recurse
-                        handle_elts(node.elts)
-                        continue
+@functools.lru_cache(maxsize=None)
+def _importable_star_names(module_name: str) -> frozenset[str]:
+    """
+    Get the public names of a module (cached), which is what `from module_name import *` would define.
 
-                    if var := getattr(node, "id", None):
-                        defined_variables.add(var)
-                except Exception as e:  # pragma: no cover
-                    warnings.warn("Something went wrong trying to find variables.", source=e)
-                    # raise
+    Raises ImportError if the module can't be imported, which lru_cache does not store.
+    """
+    imported_module = importlib.import_module(module_name)
+    return frozenset(name for name in dir(imported_module) if not name.startswith("_"))
 
-        handle_elts(node.targets if hasattr(node, "targets") else [node.target])
 
-    def collect_imports(node: ast.AST) -> None:
-        """
-        Get defined variables via imports.
-        """
-        if isinstance(node, ast.Import):
-            for alias in node.names:
-                imported_names.add(alias.name)
-        elif isinstance(node, ast.ImportFrom) and node.module:
-            module_name = node.module
-            with contextlib.suppress(ImportError):
-                imported_module = importlib.import_module(module_name)
+def _star_names(module_name: str) -> frozenset[str]:
+    """
+    Get the names `from module_name import *` would define, or none if the module can't be imported (yet).
 
-                if node.names[0].name == "*":
-                    imported_names.update(name for name in dir(imported_module) if not name.startswith("_"))
-                else:
-                    imported_names.update(alias.asname or alias.name for alias in node.names)
+    Only successful imports are cached, so a failed import is tried again next time.
+    """
+    try:
+        return _importable_star_names(module_name)
+    except ImportError:
+        return frozenset()
 
-    def collect_imported_names(node: ast.AST) -> None:
-        """
-        Get defined variables via import from.
-        """
-        if isinstance(node, ast.ImportFrom) and node.module:
-            for alias in node.names:
-                imported_names.add(alias.asname or alias.name)
 
-    def collect_loop_variables(node: ast.AST) -> None:
-        """
-        Get variables defined in a loop (for var in ...).
-        """
-        if isinstance(node, ast.For) and isinstance(node.target, ast.Name):
-            loop_variables.add(node.target.id)
+_Load = ast.Load
+_Store = ast.Store
+_Del = ast.Del
 
-    def collect_everything(node: ast.AST) -> None:
-        """
-        Run the functions above to get all variables from the code.
-        """
-        collect_variables(node)
-        collect_definitions(node)
-        collect_imported_names(node)
-        collect_imports(node)
-        collect_loop_variables(node)
+
+def _collect_name(node: ast.Name, state: _VariableState) -> None:
+    """
+    Collect or remove variables based on load/store and delete statements.
+    """
+    # Name is the most common node, so compare the exact context type instead of isinstance:
+    ctx_t = type(node.ctx)
+    if ctx_t is _Load:
+        state.used.add(node.id)
+    elif ctx_t is _Store:
+        state.defined.add(node.id)
+    elif ctx_t is _Del:
+        state.defined.discard(node.id)
+
+
+def _collect_definitions(node: ast.Assign, state: _VariableState) -> None:
+    """
+    Collect variable definitions via other ways (x = ...).
+    """
+    variables: set[str] = set()
+    _handle_elts(node.targets, variables)
+    state.assigned |= variables
+    state.defined |= variables
+
+
+def _collect_annotated_definitions(node: ast.AnnAssign, state: _VariableState) -> None:
+    """
+    Collect variable definitions via other ways (x: int = ...).
+    """
+    variables: set[str] = set()
+    _handle_elts([node.target], variables)
+    state.assigned |= variables
+    state.defined |= variables
+
+
+def _collect_import(node: ast.Import, state: _VariableState) -> None:
+    """
+    Get defined variables via imports.
+    """
+    # `import os.path` defines `os`:
+    state.imported_names.update(alias.asname or alias.name.partition(".")[0] for alias in node.names)
+
+
+def _collect_import_from(node: ast.ImportFrom, state: _VariableState) -> None:
+    """
+    Get defined variables via import from.
+    """
+    if node.names[0].name != "*":
+        state.imported_names.update(alias.asname or alias.name for alias in node.names)
+    elif node.module and not node.level:
+        # relative star imports can't be resolved without knowing the package
+        state.star_imports.add(node.module)
+
+
+def _collect_loop_variables(node: ast.For, state: _VariableState) -> None:
+    """
+    Get variables defined in a loop (for var in ...).
+    """
+    if type(node.target) is ast.Name:
+        state.loop.add(node.target.id)
+
+
+# one handler per node type, so every node only needs a single dict lookup:
+_DISPATCH: dict[type[ast.AST], typing.Callable[[Any, _VariableState], None]] = {
+    ast.Name: _collect_name,
+    ast.Assign: _collect_definitions,
+    ast.AnnAssign: _collect_annotated_definitions,
+    ast.Import: _collect_import,
+    ast.ImportFrom: _collect_import_from,
+    ast.For: _collect_loop_variables,
+}
+
+
+@dataclass(frozen=True, slots=True)
+class Analysis:
+    """
+    All variable info `analyze` found in a piece of code.
+
+    Attributes:
+        used: variables that are read.
+        defined: variables that are stored (and not deleted afterwards).
+        assigned: variables that are directly assigned (`x = 5`, see `find_defined_variables`).
+        imported: names defined by imports.
+        loop: names defined as for-loop variable.
+        star_imports: modules imported with `from module import *` (not relative ones).
+    """
+
+    used: frozenset[str]
+    defined: frozenset[str]
+    assigned: frozenset[str]
+    imported: frozenset[str]
+    loop: frozenset[str]
+    star_imports: frozenset[str]
+
+
+_ANALYSIS_FIELDS = frozenset(attr.name for attr in fields(Analysis))
+
+
+@functools.lru_cache(maxsize=128)
+def analyze(code_str: str) -> Analysis:
+    """
+    Collects all variable info of the given code string in a single pass over its AST.
+
+    The result is cached, so e.g. `find_defined_variables` and `find_missing_variables` on the same code
+    only parse and walk it once.
+    Set the `WITCHERY_CACHE` environment variable to a (sqlite) file path to also cache results across processes.
+
+    Args:
+        code_str (str): The code string to parse for variables.
+
+    Returns:
+        Analysis: the used, defined, assigned, imported and loop variables, and the star imported modules.
+    """
+    if (cached := _cache.load(code_str)) is not None and cached.keys() == _ANALYSIS_FIELDS:
+        return Analysis(**{key: frozenset(names) for key, names in cached.items()})
+
+    # Partly made by ChatGPT
+    # keep `code_str` as is, since it's the key for the persistent cache:
+    code = code_str
+    if _LEADING_INDENT.match(code):
+        # only dedent if required, since it scans (and copies) the whole string:
+        code = textwrap.dedent(code)
+
+    # could raise SyntaxError; not `_parse`, since only the (cached) analysis is needed afterwards:
+    tree = _parse_fresh(code)
+
+    state = _VariableState()
 
     # manually rewritten (2.19s for 10k):
-    traverse_ast(tree, collect_everything)
+    state.collect(tree)
+
+    analysis = Analysis(
+        used=frozenset(state.used),
+        defined=frozenset(state.defined),
+        assigned=frozenset(state.assigned),
+        imported=frozenset(state.imported_names),
+        loop=frozenset(state.loop),
+        star_imports=frozenset(state.star_imports),
+    )
+
+    _cache.store(
+        code_str,
+        analysis={attr.name: sorted(getattr(analysis, attr.name)) for attr in fields(Analysis)},
+    )
+    return analysis
+
+
+def _star_imported(analysis: Analysis, resolve_star: bool) -> list[frozenset[str]]:
+    """
+    Get the names defined by the star imports of this analysis, one set per module.
+
+    Modules are only imported here (so not by `analyze`), since that executes their code.
+    """
+    if not resolve_star:
+        return []
+    return [_star_names(module_name) for module_name in analysis.star_imports]
+
+
+def find_variables(code_str: str, with_builtins: bool = True, resolve_star: bool = True) -> tuple[set[str], set[str]]:
+    """
+    Finds all used and defined variables in the given code string.
+
+    Args:
+        code_str (str): The code string to parse for variables.
+        with_builtins (bool): include Python builtins?
+        resolve_star (bool): import modules to find the names defined by `from module import *`?
+            This executes that module's code (once per process)!
+
+    Returns:
+        tuple: A tuple containing sets of used and defined variables.
+    """
+    analysis = analyze(code_str)
 
-    all_variables = (
-        defined_variables | imported_modules | loop_variables | imported_names | (BUILTINS if with_builtins else set())
+    # one union call instead of a new intermediate set per `|`:
+    all_variables = set().union(
+        analysis.defined,
+        analysis.loop,
+        analysis.imported,
+        *_star_imported(analysis, resolve_star),
+        BUILTINS if with_builtins else (),
     )
 
-    return used_variables, all_variables
+    return set(analysis.used), all_variables
 
 
-def find_missing_variables(code: str) -> set[str]:
+def find_missing_variables(code: str, resolve_star: bool = True) -> set[str]:
     """
     Finds and returns all missing variables in the given code.
 
     Args:
         code (str): The code to check for missing variables.
+        resolve_star (bool): import modules to find the names defined by `from module import *`?
+            If False, names that may come from a star import are reported as missing.
 
     Returns:
         set: A set of names of missing variables.
     """
-    used_variables, defined_variables = find_variables(code)
-    return {var for var in used_variables if var not in defined_variables}
+    analysis = analyze(code)
+    # subtract each set instead of building their (large, because of builtins) union like `find_variables` does:
+    return set(
+        analysis.used.difference(
+            analysis.defined,
+            analysis.imported,
+            analysis.loop,
+            *_star_imported(analysis, resolve_star),
+            BUILTINS,
+        )
+    )
 
 
 T = typing.TypeVar("T", bound=Any)
@@ -566,6 +954,19 @@ class Empty:
         return other
 
 
+# built once, instead of reading the source of Empty from disk on every `generate_magic_code` call:
+_MAGIC_PRELUDE = (
+    "import typing; from typing import Any; "
+    "from typing_extensions import Self; "
+    "T = typing.TypeVar('T', bound=Any); "
+    "\n"
+    f"{inspect.getsource(Empty)}"
+    "\n\n"
+    "empty = Empty()"
+    "\n"
+)
+
+
 def generate_magic_code(missing_vars: set[str]) -> str:
     """
     Generates code to define missing variables with a do-nothing object.
@@ -579,20 +980,5 @@ def generate_magic_code(missing_vars: set[str]) -> str:
     Returns:
         str: The generated code.
     """
-    extra_code = (
-        "import typing; from typing import Any; "
-        "from typing_extensions import Self; "
-        "T = typing.TypeVar('T', bound=Any); "
-        "\n"
-    )
-
-    extra_code += inspect.getsource(Empty)
-
-    extra_code += "\n\n"
-    extra_code += "empty = Empty()"
-    extra_code += "\n"
-
-    for variable in missing_vars:
-        extra_code += f"{variable} = empty; "
-
-    return textwrap.dedent(extra_code)
+    # sorted, so the same missing vars always result in the same code:
+    return _MAGIC_PRELUDE + "".join(f"{variable} = empty; " for variable in sorted(missing_vars))
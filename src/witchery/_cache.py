@@ -0,0 +1,96 @@
+"""
+Optional persistent cache for `analyze` results, so unchanged code is not parsed again in every new process.
+
+Enable it by setting the `WITCHERY_CACHE` environment variable to the path of a sqlite file,
+e.g. `~/.cache/witchery/ast.sqlite`.
+"""
+
+# SPDX-FileCopyrightText: 2023-present Robin van der Noord <robinvandernoord@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import typing
+from pathlib import Path
+
+from .__about__ import __version__
+
+CACHE_ENV_VAR = "WITCHERY_CACHE"
+
+# bump when the shape of the stored analysis changes, so rows written by older code are not read:
+SCHEMA_VERSION = 2
+
+CachedAnalysis = dict[str, list[str]]
+
+
+def cache_path() -> Path | None:
+    """
+    Get the location of the cache file, or None if the persistent cache is disabled.
+    """
+    if path := os.getenv(CACHE_ENV_VAR):
+        return Path(path).expanduser()
+    return None
+
+
+def digest(code: str) -> str:
+    """
+    Key for the cache; includes the witchery version and schema so results of older code are not reused.
+    """
+    return hashlib.sha256(f"{__version__}\n{SCHEMA_VERSION}\n{code}".encode()).hexdigest()
+
+
+def _is_valid(data: typing.Any) -> bool:
+    """
+    Check if data read from the cache has the shape of a stored analysis (names per kind of variable).
+    """
+    return isinstance(data, dict) and all(
+        isinstance(names, list) and all(isinstance(name, str) for name in names) for names in data.values()
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def _connect(path: Path) -> sqlite3.Connection:
+    """
+    Open (and set up) the cache database, once per path.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("CREATE TABLE IF NOT EXISTS analysis (sha TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    return connection
+
+
+def load(code: str) -> CachedAnalysis | None:
+    """
+    Get the stored analysis of this code, if the cache is enabled and has it.
+
+    Invalid data (e.g. written by a different version) counts as a miss.
+    """
+    if not (path := cache_path()):
+        return None
+
+    # the cache is only an optimization, so any problem with it should not break the analysis:
+    with contextlib.suppress(sqlite3.Error, OSError, ValueError, TypeError):
+        row = _connect(path).execute("SELECT data FROM analysis WHERE sha = ?", (digest(code),)).fetchone()
+        if row and _is_valid(data := json.loads(row[0])):
+            return typing.cast(CachedAnalysis, data)
+
+    return None
+
+
+def store(code: str, analysis: CachedAnalysis) -> None:
+    """
+    Save the analysis of this code, if the cache is enabled.
+    """
+    if not (path := cache_path()):
+        return
+
+    with contextlib.suppress(sqlite3.Error, OSError), _connect(path) as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO analysis (sha, data) VALUES (?, ?)",
+            (digest(code), json.dumps(analysis)),
+        )
@@ -0,0 +1,77 @@
+import sqlite3
+
+from src.witchery import _cache, analyze, find_defined_variables, find_missing_variables
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.delenv(_cache.CACHE_ENV_VAR, raising=False)
+
+    assert _cache.cache_path() is None
+    assert _cache.load("a = 1") is None
+    _cache.store("a = 1", analysis={"assigned": ["a"]})  # no-op
+
+
+def test_persistent_cache(monkeypatch, tmp_path):
+    path = tmp_path / "nested" / "ast.sqlite"
+    monkeypatch.setenv(_cache.CACHE_ENV_VAR, str(path))
+    code = "persistent_one = 1\nprint(persistent_two)"
+
+    assert _cache.load(code) is None
+    analysis = analyze(code)
+    assert path.exists()
+
+    stored = _cache.load(code)
+    assert stored["assigned"] == ["persistent_one"]
+    assert stored["used"] == ["persistent_two", "print"]
+
+    # results are read from disk instead of parsing the code again:
+    other_code = "not_this = 1"
+    _cache.store(other_code, analysis={**stored, "assigned": ["but_this"]})
+    assert find_defined_variables(other_code) == {"but_this"}
+    assert analyze(other_code).used == analysis.used
+
+    with sqlite3.connect(path) as connection:
+        assert connection.execute("SELECT count(*) FROM analysis").fetchone() == (2,)
+
+
+def test_indented_code(monkeypatch, tmp_path):
+    monkeypatch.setenv(_cache.CACHE_ENV_VAR, str(tmp_path / "ast.sqlite"))
+    code = "    indented_one = 1\n    indented_two = indented_one"
+
+    assert find_defined_variables(code) == {"indented_one", "indented_two"}
+    # stored under the code as it was passed, so the next process finds it:
+    assert _cache.load(code)["assigned"] == ["indented_one", "indented_two"]
+
+
+def test_star_import_names_are_not_stored(monkeypatch, tmp_path):
+    monkeypatch.setenv(_cache.CACHE_ENV_VAR, str(tmp_path / "ast.sqlite"))
+    code = "from math import *\nstored_star = floor(pi)"
+
+    assert find_missing_variables(code) == set()
+    # only the module is stored, its names are resolved again in every process (so they can't go stale):
+    stored = _cache.load(code)
+    assert stored["star_imports"] == ["math"]
+    assert stored["imported"] == []
+
+
+def test_invalid_rows(monkeypatch, tmp_path):
+    monkeypatch.setenv(_cache.CACHE_ENV_VAR, str(tmp_path / "ast.sqlite"))
+
+    # e.g. written by an older version, without all fields:
+    _cache.store("old = 1", analysis={"assigned": ["wrong"]})
+    assert find_defined_variables("old = 1") == {"old"}
+
+    _cache.store("wrong_type = 1", analysis={"used": 5})
+    assert _cache.load("wrong_type = 1") is None
+    assert find_defined_variables("wrong_type = 1") == {"wrong_type"}
+
+    _cache.store("not_a_dict = 1", analysis=["not_a_dict"])
+    assert _cache.load("not_a_dict = 1") is None
+
+
+def test_broken_cache(monkeypatch, tmp_path):
+    # a directory can't be opened as a database, but that should not break the analysis:
+    monkeypatch.setenv(_cache.CACHE_ENV_VAR, str(tmp_path))
+
+    assert _cache.load("broken = 1") is None
+    assert find_defined_variables("broken = 1") == {"broken"}
@@ -1,19 +1,33 @@
+import ast
+import functools
+import sys
 import textwrap
+import types
 
 import pytest
 
 from src.witchery import (
+    Analysis,
     add_function_call,
+    add_function_call_tree,
+    analyze,
     extract_function_details,
     find_defined_variables,
     find_function_to_call,
     find_missing_variables,
+    find_variables,
     generate_magic_code,
     has_local_imports,
+    pipeline,
+    remove_if_falsey_blocks,
+    remove_if_falsey_blocks_tree,
     remove_import,
+    remove_import_tree,
     remove_local_imports,
+    remove_local_imports_tree,
     remove_specific_variables,
-    remove_if_falsey_blocks,
+    remove_specific_variables_tree,
+    traverse_ast,
 )
 
 CODE_STRING = """
@@ -51,6 +65,7 @@ more_args["one"] = 2
 
 # tuple:
 tuple_one, tuple_two = 1, 2
+first, *rest = 1, 2, 3
 """
 
 
@@ -58,7 +73,69 @@ def test_find_defined():
     # defined: `variable = value` in code (so not imported or in loop etc.)
     all_variables = find_defined_variables(CODE_STRING)
 
-    assert all_variables == {"a", "b", "d", "f", "db", "driver_args", "tuple_one", "tuple_two", "more_args"}
+    assert all_variables == {
+        "a",
+        "b",
+        "d",
+        "f",
+        "db",
+        "driver_args",
+        "tuple_one",
+        "tuple_two",
+        "more_args",
+        "first",
+        "rest",
+    }
+
+    # only names are definitions, attributes are not:
+    assert find_defined_variables("[x, (y, *z)] = obj.attr, item[0] = 1, 2, 3") == {"x", "y", "z", "item"}
+
+
+def test_analyze():
+    analysis = analyze(CODE_STRING)
+    assert isinstance(analysis, Analysis)
+    assert analysis is analyze(CODE_STRING)  # cached
+
+    assert analysis.assigned == find_defined_variables(CODE_STRING)
+    assert "f" in analysis.assigned
+    assert "f" not in analysis.defined  # del f
+    assert analysis.loop == {"table"}
+    assert {"floor", "datetime"} <= analysis.imported
+    assert analysis.star_imports == {"pydal"}  # only resolved (imported) by find_variables/find_missing_variables
+    assert {"print", "c", "xyz"} <= analysis.used
+
+
+def test_analyze_shared_cache():
+    code = "shared_cache = 1\nprint(shared_cache, other)"
+    before = analyze.cache_info()
+
+    find_defined_variables(code)
+    find_variables(code)
+    find_missing_variables(code, resolve_star=False)
+
+    after = analyze.cache_info()
+    # every finder uses the same cache entry, so the code is only analyzed once:
+    assert (after.misses - before.misses, after.hits - before.hits) == (1, 2)
+
+
+def test_traverse_ast():
+    names = []
+
+    def collect_names(node):
+        if isinstance(node, ast.Name):
+            names.append(node.id)
+
+    traverse_ast(ast.parse("a = b + c\nprint(d[e])"), collect_names)
+    assert names == ["a", "b", "c", "print", "d", "e"]
+
+
+def test_find_variables():
+    used, defined = find_variables("x = 5\ny = x + z\nresult = x * y", with_builtins=False)
+    assert used == {"x", "y", "z"}
+    assert defined == {"x", "y", "result"}
+
+    _, defined = find_variables("x = 5")
+    assert {"x", "print", "len"} <= defined
 
 
 def test_find_missing():
@@ -66,10 +143,64 @@ def test_find_missing():
     missing_variables = find_missing_variables(CODE_STRING)
     assert missing_variables == {"c", "xyz", "ceil", "e", "f"}, missing_variables
 
+    # indented code is dedented first:
+    assert find_missing_variables(textwrap.indent(CODE_STRING, "    ")) == missing_variables
+
+
+def test_find_missing_star_import():
+    # names from a star import can only be resolved if the module can be imported:
+    assert find_missing_variables("from math import *\nfloor(pi)") == set()
+    assert find_missing_variables("from doesnt_exist import *\nfloor(pi)") == {"floor", "pi"}
+    assert find_missing_variables("from .math import *\nfloor(pi)") == {"floor", "pi"}
+    assert find_missing_variables("from math import *\nfloor(pi)", resolve_star=False) == {"floor", "pi"}
+
+
+def test_star_import_retried(monkeypatch):
+    code = "from later_module import *\nlater_name"
+    assert find_missing_variables(code) == {"later_name"}
+
+    # a module that couldn't be imported before is tried again:
+    later_module = types.ModuleType("later_module")
+    later_module.later_name = True
+    monkeypatch.setitem(sys.modules, "later_module", later_module)
+    assert find_missing_variables(code) == set()
+
+
+def test_star_import_is_lazy():
+    # only parsing the code should not import (and execute) star imported modules:
+    assert find_defined_variables("from this import *\nq = 1") == {"q"}
+    assert analyze("from this import *\nq = 1").star_imports == {"this"}
+    assert "this" not in sys.modules
+
+
+def test_find_missing_imports():
+    code = textwrap.dedent(
+        """
+    import os.path
+    import datetime as dt
+    from math import floor as round_down
+    from . import local
+
+    os.getcwd(), dt.date, round_down, local, datetime, floor
+    """
+    )
+    assert find_missing_variables(code) == {"datetime", "floor"}
+
+
+def test_syntax_error():
+    with pytest.raises(SyntaxError) as exc_info:
+        find_missing_variables("x = (")
+
+    assert exc_info.value.filename == "<witchery>"
+
 
 def test_find_local_imports():
     assert has_local_imports("from .math import floor")
     assert not has_local_imports("from math import floor")
+    assert has_local_imports("def nested():\n    from .math import floor")
+    assert has_local_imports("try:\n    pass\nexcept ImportError:\n    from .math import floor")
+    assert has_local_imports("match x:\n    case 1:\n        from .math import floor")
+    assert not has_local_imports("x = lambda: None\nif x:\n    from math import floor")
 
 
 def test_remove_import():
@@ -113,6 +244,9 @@ def test_remove_local_imports():
     from .other import method3
     from typing import *
     from math import floor
+
+    if TYPE_CHECKING:
+        from .models import method4
     """
     )
     new_code = remove_local_imports(code)
@@ -131,6 +265,10 @@ def test_find_function_to_call():
     
     def other(arg: int):
         ...
+
+    class Nested:
+        def method(self):
+            ...
     """
     )
 
@@ -139,6 +277,7 @@ def test_find_function_to_call():
     assert find_function_to_call(code, "main(1, 2)") == "main"
     assert find_function_to_call(code, "other") == "other"
     assert find_function_to_call(code, "other(1, 2)") == "other"
+    assert find_function_to_call(code, "method") == "method"
     assert find_function_to_call(code, "doesnt_exist") is None
     assert find_function_to_call(code, "doesnt_exist()") is None
 
@@ -161,6 +300,17 @@ def test_extract_function_details():
 
     assert extract_function_details("syntax_error(") == (None, [])
 
+    # simple arguments (without the AST):
+    assert extract_function_details("my_method( first ,2, None, '')") == ("my_method", ["first", "2", "None", "''"])
+    assert extract_function_details("my_method(if)") == (None, [])
+    assert extract_function_details("if(first)") == (None, [])
+
+    # complex arguments (normalized by the AST):
+    assert extract_function_details('my_method("second", 1_000)') == ("my_method", ["'second'", "1000"])
+    assert extract_function_details("my_method('a, b', c.d, [1])") == ("my_method", ["'a, b'", "c.d", "[1]"])
+    assert extract_function_details("my_method(first,)") == ("my_method", ["first"])
+    assert extract_function_details("my_method(key=1)", default_args=["arg1"]) == ("my_method", ["arg1"])
+
 
 def test_add_function_call():
     code = textwrap.dedent(
@@ -211,6 +361,9 @@ def test_add_function_call():
 
     assert add_function_call(code, "main", args=["'World'"], multiple=True).strip() == target.strip()
 
+    # only after the first one:
+    assert add_function_call(code, "main", args=["'World'"]).count("main('World')") == 1
+
 
 def test_fix_missing():
     code = generate_magic_code({"bla"})
@@ -218,6 +371,9 @@ def test_fix_missing():
     assert "empty = Empty()" in code
     assert "bla = empty" in code
 
+    code = generate_magic_code({"b", "c", "a"})
+    assert code.endswith("\na = empty; b = empty; c = empty; ")
+
 
 def test_remove_specific_variables():
     code = textwrap.dedent(
@@ -228,6 +384,17 @@ def test_remove_specific_variables():
     
     my_database = 'exists'
     print('hi')
+
+    def main():
+        print('main')
+
+    class Models:
+        print('models')
+
+    if True:
+        pass
+    else:
+        db = DAL('else')
     """
     )
     new_code = remove_specific_variables(code)
@@ -236,6 +403,13 @@ def test_remove_specific_variables():
     assert "DAL" not in new_code
     assert "def database" not in new_code
     assert "my_database" in new_code
+    assert "def main" in new_code
+    assert "class Models" in new_code
+
+    new_code = remove_specific_variables(code, to_remove=(name for name in ["main", "Models"]))
+    assert "DAL('else')" in new_code
+    assert "main" not in new_code
+    assert "Models" not in new_code
 
 
 def test_remove_if_falsey_blocks():
@@ -283,3 +457,56 @@ def test_remove_if_falsey_blocks():
     # assert "sixth" in after
     # assert "seventh" not in after
     # assert "eight" not in after
+
+
+def test_pipeline():
+    code = textwrap.dedent(
+        """
+    import typing
+    import fake_module
+    from .local import method1
+
+    if typing.TYPE_CHECKING:
+        import another_fake
+
+    print('hi')
+    """
+    )
+
+    with pytest.warns(Warning):
+        assert pipeline(code, [functools.partial(remove_import_tree, module_name="")]) == pipeline(code, [])
+
+    new_code = pipeline(
+        code,
+        [
+            remove_local_imports_tree,
+            remove_if_falsey_blocks_tree,
+            functools.partial(remove_import_tree, module_name="fake_module"),
+        ],
+    )
+
+    assert new_code == remove_import(remove_if_falsey_blocks(remove_local_imports(code)), "fake_module")
+    assert "import typing" in new_code
+    assert "fake_module" not in new_code
+    assert "local" not in new_code
+    assert "another_fake" not in new_code
+    assert "print('hi')" in new_code
+
+    code = textwrap.dedent(
+        """
+    db = DAL()
+
+    def main(db):
+        ...
+    """
+    )
+    new_code = pipeline(
+        code,
+        [
+            remove_specific_variables_tree,
+            functools.partial(add_function_call_tree, function_call="main", args=["empty"]),
+        ],
+    )
+    assert new_code == add_function_call(remove_specific_variables(code), "main", args=["empty"])
+    assert "DAL" not in new_code
+    assert "main(empty)" in new_code